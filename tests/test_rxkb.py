@@ -130,3 +130,239 @@ class TestContext(TestCase):
                 break
         else:
             self.fail(msg="lv2 option group not found")
+
+    def test_options(self):
+        ctx = rxkb.Context(no_default_includes=True)
+        ctx.include_path_append(testdir)
+        ctx.parse("test-base")
+        self.assertIn("lv2:lsgt_switch", ctx.options)
+        self.assertEqual(ctx.options["lv2:lsgt_switch"].description,
+                         'The "< >" key')
+
+    def test_warm(self):
+        ctx = rxkb.Context(no_default_includes=True)
+        ctx.include_path_append(testdir)
+        ctx.parse("test-base")
+        self.assertFalse(ctx.warmed)
+        self.assertIsNone(ctx.warm())
+        self.assertTrue(ctx.warmed)
+        self.assertTrue(ctx.wait_warm(timeout=0))
+        self.assertIn("pc102", ctx.models)
+        self.assertIn("us(chr)", ctx.layouts)
+
+    def test_warm_background(self):
+        ctx = rxkb.Context(no_default_includes=True)
+        ctx.include_path_append(testdir)
+        ctx.parse("test-base")
+        t = ctx.warm(background=True)
+        self.assertTrue(ctx.wait_warm(timeout=10))
+        t.join()
+        self.assertIn("us", ctx.layouts)
+
+    def test_warm_failure(self):
+        # There's no default ruleset in the test directory
+        ctx = rxkb.Context(no_default_includes=True)
+        ctx.include_path_append(testdir)
+        with self.assertRaises(rxkb.RXKBParseError):
+            ctx.warm()
+        with self.assertRaises(rxkb.RXKBWarmError):
+            ctx.warmed
+
+    def test_warm_background_failure(self):
+        ctx = rxkb.Context(no_default_includes=True)
+        ctx.include_path_append(testdir)
+        t = ctx.warm(background=True)
+        t.join()
+        with self.assertRaises(rxkb.RXKBWarmError) as cm:
+            ctx.wait_warm(timeout=10)
+        self.assertIsInstance(cm.exception.__cause__, rxkb.RXKBParseError)
+        with self.assertRaises(rxkb.RXKBWarmError):
+            ctx.warmed
+
+    def test_warm_background_retry(self):
+        ctx = rxkb.Context(no_default_includes=True)
+        ctx.include_path_append(testdir)
+        with self.assertRaises(rxkb.RXKBWarmError):
+            ctx.wait_warm(timeout=0)
+        ctx.warm(background=True).join()
+        with self.assertRaises(rxkb.RXKBWarmError):
+            ctx.wait_warm(timeout=10)
+        ctx.parse("test-base")
+        t = ctx.warm(background=True)
+        # The earlier failure must not be reported for the new attempt
+        ctx.wait_warm(timeout=0)
+        self.assertTrue(ctx.wait_warm(timeout=10))
+        t.join()
+        self.assertTrue(ctx.warmed)
+
+    def test_preload(self):
+        ctx = rxkb.Context(no_default_includes=True, preload=True)
+        ctx.include_path_append(testdir)
+        self.assertFalse(ctx.warmed)
+        ctx.parse("test-base")
+        self.assertTrue(ctx.warmed)
+        self.assertIn("lv2:lsgt_switch", ctx.options)
+
+    def test_memory_usage(self):
+        ctx = rxkb.Context(no_default_includes=True)
+        ctx.include_path_append(testdir)
+        ctx.parse("test-base")
+        ctx.warm()
+        usage = ctx.memory_usage()
+        for kind in ('objects', 'strings', 'frozensets', 'native'):
+            self.assertGreater(usage[kind], 0)
+        self.assertEqual(usage['total'],
+                         usage['objects'] + usage['strings']
+                         + usage['frozensets'] + usage['native'])
+
+    def test_max_decoded_records(self):
+        with self.assertRaises(ValueError):
+            rxkb.Context(max_decoded_records=0)
+        ctx = rxkb.Context(no_default_includes=True, max_decoded_records=2)
+        ctx.include_path_append(testdir)
+        ctx.parse("test-base")
+        self.assertIn("us(chr)", ctx.layouts)
+        self.assertNotIn("must-not-exist", ctx.layouts)
+        with self.assertRaises(KeyError):
+            ctx.layouts["must-not-exist"]
+        for name in list(ctx.layouts)[:10]:
+            self.assertEqual(ctx.layouts[name].fullname, name)
+        self.assertEqual(ctx.layouts["us"].description, "English (US)")
+        self.assertEqual(ctx.models["pc102"].vendor, "Generic")
+        # Models and layouts share the budget
+        us = ctx.layouts["us"]
+        self.assertIs(ctx.layouts["us"], us)
+        ctx.models["pc101"]
+        ctx.models["pc102"]
+        self.assertIsNot(ctx.layouts["us"], us)
+        uncapped = rxkb.Context(no_default_includes=True)
+        uncapped.include_path_append(testdir)
+        uncapped.parse("test-base")
+        self.assertEqual(len(ctx.layouts), len(uncapped.layouts))
+        ctx.warm()
+        uncapped.warm()
+        self.assertLess(ctx.memory_usage()['objects'],
+                        uncapped.memory_usage()['objects'])
+
+    def test_parse_options(self):
+        ctx = rxkb.Context(no_default_includes=True)
+        ctx.include_path_append(testdir)
+        ctx.parse("test-base")
+        s = "compose:ralt,ctrl:nocaps,,grp:alt_shift_toggle,ctrl:nocaps"
+        x = ctx.parse_options(s)
+        self.assertTrue(x.valid)
+        self.assertEqual(str(x), "grp:alt_shift_toggle,ctrl:nocaps,"
+                         "compose:ralt")
+        self.assertIs(x.options[1], ctx.options["ctrl:nocaps"])
+        self.assertIs(ctx.parse_options(s), x)
+
+    def test_parse_options_invalid(self):
+        ctx = rxkb.Context(no_default_includes=True)
+        ctx.include_path_append(testdir)
+        ctx.parse("test-base")
+        x = ctx.parse_options("altwin:menu,no:such-option,altwin:menu_win")
+        self.assertFalse(x.valid)
+        self.assertEqual(x.unknown, ("no:such-option",))
+        self.assertEqual(len(x.conflicts), 1)
+        group, options = x.conflicts[0]
+        self.assertEqual(group.name, "altwin")
+        self.assertEqual([str(o) for o in options],
+                         ["altwin:menu", "altwin:menu_win"])
+
+
+class TestOverlayRegistry(TestCase):
+    def _test_context(self, ruleset):
+        ctx = rxkb.Context(no_default_includes=True)
+        ctx.include_path_append(testdir)
+        ctx.parse(ruleset)
+        return ctx
+
+    def test_precedence(self):
+        base = self._test_context("test-base")
+        vendor = self._test_context("test-vendor")
+        overlay = rxkb.OverlayRegistry([vendor, base])
+        self.assertEqual(overlay.contexts, (vendor, base))
+        # Shadowed by the first context
+        self.assertIs(overlay.models["pc102"], vendor.models["pc102"])
+        self.assertEqual(overlay.models["pc102"].vendor, "Vendor")
+        self.assertEqual(overlay.layouts["us"].description,
+                         "English (US, vendor)")
+        self.assertIs(overlay.options["altwin:menu"],
+                      vendor.options["altwin:menu"])
+        # Only in the second context
+        self.assertIs(overlay.models["pc101"], base.models["pc101"])
+        self.assertIs(overlay.layouts["us(chr)"], base.layouts["us(chr)"])
+        self.assertIs(overlay.options["altwin:menu_win"],
+                      base.options["altwin:menu_win"])
+        altwin = [g for g in overlay.option_groups if g.name == "altwin"]
+        self.assertEqual(len(altwin), 1)
+        self.assertEqual(altwin[0].description,
+                         "Vendor Alt and Win behavior")
+
+    def test_merge(self):
+        base = self._test_context("test-base")
+        vendor = self._test_context("test-vendor")
+        overlay = rxkb.OverlayRegistry([base, vendor])
+        # Shadowed by the first context
+        self.assertIs(overlay.models["pc102"], base.models["pc102"])
+        self.assertEqual(overlay.layouts["us"].description, "English (US)")
+        # Only in the second context
+        self.assertIs(overlay.models["vendorboard"],
+                      vendor.models["vendorboard"])
+        self.assertIs(overlay.layouts["vendor(alt)"],
+                      vendor.layouts["vendor(alt)"])
+        self.assertIn("vendor:one", overlay.options)
+        self.assertEqual(set(overlay.layouts),
+                         set(base.layouts) | set(vendor.layouts))
+        names = [g.name for g in overlay.option_groups if g.name]
+        self.assertEqual(len(names), len(set(names)))
+        self.assertIn("vendor", names)
+
+    def test_parse_options(self):
+        overlay = rxkb.OverlayRegistry([self._test_context("test-base")])
+        x = overlay.parse_options("altwin:menu,ctrl:nocaps,altwin:menu_win")
+        self.assertEqual(str(x), "ctrl:nocaps,altwin:menu,altwin:menu_win")
+        self.assertEqual(len(x.conflicts), 1)
+
+    def test_merged_option_groups(self):
+        base = self._test_context("test-base")
+        vendor = self._test_context("test-vendor")
+        overlay = rxkb.OverlayRegistry([base, vendor])
+        altwin = [g for g in overlay.option_groups if g.name == "altwin"]
+        self.assertEqual(len(altwin), 1)
+        altwin = altwin[0]
+        base_altwin = [g for g in base.option_groups
+                       if g.name == "altwin"][0]
+        self.assertIsNot(altwin, base_altwin)
+        self.assertFalse(altwin.allows_multiple)
+        self.assertEqual(altwin.description, base_altwin.description)
+        self.assertIs(altwin.options["altwin:menu"],
+                      base_altwin.options["altwin:menu"])
+        self.assertIs(altwin.options["altwin:vendor_a"],
+                      vendor.options["altwin:vendor_a"])
+        self.assertEqual(list(altwin.options)[-2:],
+                         ["altwin:vendor_a", "altwin:vendor_b"])
+        # The contexts' own groups are untouched
+        self.assertNotIn("altwin:vendor_a", base_altwin.options)
+
+    def test_parse_options_shadowed_group(self):
+        base = self._test_context("test-base")
+        vendor = self._test_context("test-vendor")
+        # The base altwin group doesn't allow multiple selection, so
+        # neither does the merged group, even for the vendor options
+        overlay = rxkb.OverlayRegistry([base, vendor])
+        x = overlay.parse_options("altwin:vendor_b,altwin:menu")
+        self.assertFalse(x.valid)
+        self.assertEqual(str(x), "altwin:menu,altwin:vendor_b")
+        group, options = x.conflicts[0]
+        self.assertIn(group, overlay.option_groups)
+        for option in options:
+            self.assertIs(group.options[option.name], option)
+        x = overlay.parse_options("vendor:two,vendor:one")
+        self.assertEqual(str(x), "vendor:one,vendor:two")
+        self.assertEqual(x.conflicts[0][0].name, "vendor")
+        # The vendor altwin group does allow multiple selection
+        overlay = rxkb.OverlayRegistry([vendor, base])
+        x = overlay.parse_options("altwin:menu_win,altwin:vendor_a")
+        self.assertTrue(x.valid)
+        self.assertEqual(str(x), "altwin:vendor_a,altwin:menu_win")
@@ -1,4 +1,9 @@
+import collections
+import collections.abc
+import copy
 import enum
+import sys
+import threading
 
 from xkbregistry._ffi import ffi, lib
 
@@ -18,6 +23,171 @@ def _string_or_none(r):
         return ffi.string(r).decode('utf8')
 
 
+def _layout_fullname(name, variant):
+    return f"{name}({variant})" if variant else name
+
+
+# Rough per-item sizes in bytes of the structures libxkbregistry
+# allocates for a parsed ruleset.  Used by Context.memory_usage(),
+# which cannot ask the library directly.
+#
+# Derived from the structs in src/registry.c of libxkbcommon-1.5 on an
+# LP64 platform, each of which embeds a 32 byte struct rxkb_object:
+# rxkb_model is 64 bytes, rxkb_layout 104, rxkb_option_group 80,
+# rxkb_option 64 and rxkb_iso639_code / rxkb_iso3166_code 40.  These
+# are rounded up to glibc malloc chunk sizes (80, 112, 96, 80, 48),
+# then typical chunk sizes of the strdup()ed strings each one points
+# to are added: name 32, description 48, vendor/brief/variant 32 where
+# usually present, and 32 for an ISO code.
+_NATIVE_SIZE_ESTIMATES = {
+    'model': 192,
+    'layout': 256,
+    'option_group': 176,
+    'option': 160,
+    'iso_code': 80,
+}
+
+
+# Number of distinct option strings remembered by parse_options() on
+# Context and OverlayRegistry
+_PARSE_OPTIONS_CACHE_SIZE = 256
+
+
+class _LRUCache:
+    """Thread-safe cache holding at most maxsize values"""
+    def __init__(self, maxsize):
+        self._maxsize = maxsize
+        self._values = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        """Return the value cached for key, calling compute() to
+        create it if there isn't one.
+        """
+        with self._lock:
+            try:
+                value = self._values[key]
+                self._values.move_to_end(key)
+                return value
+            except KeyError:
+                pass
+        value = compute()
+        with self._lock:
+            self._values[key] = value
+            if len(self._values) > self._maxsize:
+                self._values.popitem(last=False)
+        return value
+
+
+class _DecodedRecords(collections.abc.Mapping):
+    """Read-only mapping that decodes records from the native context
+    on demand.
+
+    Decoded records are kept in cache, an _LRUCache that may be shared
+    with other _DecodedRecords, and are decoded again from the native
+    context if they are looked up after being evicted.  Repeated
+    lookups of a key may therefore return different objects holding
+    the same data, and these do not compare equal: Model and Layout
+    compare by identity.
+
+    kind is a string that distinguishes the keys of this mapping from
+    those of others sharing the cache.
+    """
+    def __init__(self, context, records, factory, kind, cache):
+        # Holding the context keeps the native records alive
+        self._context = context
+        self._records = records
+        self._factory = factory
+        self._kind = kind
+        self._cache = cache
+
+    def __getitem__(self, key):
+        record = self._records[key]
+        return self._cache.get(
+            (self._kind, key), lambda: self._factory(record))
+
+    def __contains__(self, key):
+        return key in self._records
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+
+def _parse_options(s, option_index):
+    """Parse an option string against an option index
+
+    option_index maps option name to a tuple of (group position,
+    option position within group, OptionGroup, Option).  The
+    OptionGroup must be the one whose options include the Option.
+    """
+    seen = set()
+    known = []
+    unknown = []
+    for token in s.split(','):
+        name = token.strip()
+        if not name or name in seen:
+            continue
+        seen.add(name)
+        entry = option_index.get(name)
+        if entry is None:
+            unknown.append(name)
+        else:
+            known.append(entry)
+    known.sort(key=lambda entry: entry[:2])
+    by_group = {}
+    for _, _, group, option in known:
+        by_group.setdefault(id(group), (group, []))[1].append(option)
+    conflicts = tuple(
+        (group, tuple(options)) for group, options in by_group.values()
+        if not group.allows_multiple and len(options) > 1)
+    return ParsedOptions(
+        tuple(option for _, _, _, option in known), tuple(unknown),
+        conflicts)
+
+
+def _tally_memory(obj, tally, seen):
+    """Add the approximate size of obj and everything it refers to
+    into tally, skipping anything whose id is already in seen.
+    """
+    if isinstance(obj, (bool, int, enum.Enum, type(None))) \
+       or id(obj) in seen:
+        return
+    seen.add(id(obj))
+    if isinstance(obj, str):
+        tally['strings'] += sys.getsizeof(obj)
+    elif isinstance(obj, frozenset):
+        tally['frozensets'] += sys.getsizeof(obj)
+        for x in obj:
+            _tally_memory(x, tally, seen)
+    elif isinstance(obj, dict):
+        tally['objects'] += sys.getsizeof(obj)
+        for k, v in obj.items():
+            _tally_memory(k, tally, seen)
+            _tally_memory(v, tally, seen)
+    elif isinstance(obj, (list, tuple)):
+        tally['objects'] += sys.getsizeof(obj)
+        for x in obj:
+            _tally_memory(x, tally, seen)
+    elif isinstance(obj, _LRUCache):
+        tally['objects'] += sys.getsizeof(obj)
+        _tally_memory(obj._values, tally, seen)
+    elif isinstance(obj, _DecodedRecords):
+        tally['objects'] += sys.getsizeof(obj)
+        _tally_memory(obj._records, tally, seen)
+        _tally_memory(obj._cache, tally, seen)
+    elif isinstance(obj, (Model, Layout, OptionGroup, Option,
+                          ParsedOptions)):
+        tally['objects'] += sys.getsizeof(obj) + sys.getsizeof(vars(obj))
+        for x in vars(obj).values():
+            _tally_memory(x, tally, seen)
+    else:
+        # cdata pointers and anything else opaque
+        tally['objects'] += sys.getsizeof(obj)
+
+
 class RXKBError(Exception):
     """Base for all RXKB exceptions"""
     pass
@@ -38,6 +208,11 @@ class RXKBParseError(RXKBError):
     pass
 
 
+class RXKBWarmError(RXKBError):
+    """Context.warm() failed.  The original exception is the cause."""
+    pass
+
+
 # Internal helper for logging callback
 def _onerror_do_nothing(exception, exc_value, traceback):
     return
@@ -77,7 +252,8 @@ class Context:
     memory or state.
     """
     def __init__(self, no_default_includes=False, load_exotic_rules=False,
-                 no_secure_getenv=False):
+                 no_secure_getenv=False, preload=False,
+                 max_decoded_records=None):
         """Create a new context.
 
         Keyword arguments:
@@ -90,7 +266,22 @@ class Context:
 
         no_secure_getenv: if set, use getenv() instead of
         secure_getenv() to obtain environment variables.
+
+        preload: if set, parse() and parse_default_ruleset() call
+        warm() once they have succeeded, so that all registry data is
+        built up front rather than on first access.
+
+        max_decoded_records: if set, models and layouts are decoded
+        from the native context on demand, and at most this many Model
+        and Layout objects in total are kept alive, least recently
+        used first out.  The models and layouts properties are then
+        read-only mappings rather than dictionaries, and looking up
+        an evicted item returns a new object that does not compare
+        equal to the one returned before.  Option groups
+        and options are not capped: they are always fully decoded.
         """
+        if max_decoded_records is not None and max_decoded_records < 1:
+            raise ValueError("max_decoded_records must be at least 1")
         flags = lib.RXKB_CONTEXT_NO_FLAGS
         if no_default_includes:
             flags = flags | lib.RXKB_CONTEXT_NO_DEFAULT_INCLUDES
@@ -107,21 +298,34 @@ class Context:
         self._userdata = ffi.new_handle(self)
         lib.rxkb_context_set_user_data(self._context, self._userdata)
         self._parsed = False
+        self._preload = preload
+        self._decoded_records = None
+        if max_decoded_records is not None:
+            self._decoded_records = _LRUCache(max_decoded_records)
+        # Guards lazy construction of the registry data, which may be
+        # happening in a background thread started by warm()
+        self._lock = threading.RLock()
+        self._warmed = threading.Event()
+        self._warm_error = None
+        self._warm_started = False
+        self._parsed_options = _LRUCache(_PARSE_OPTIONS_CACHE_SIZE)
 
     def include_path_append(self, path):
         "Append a new entry to the context's include path."
-        if self._parsed:
-            raise RXKBAlreadyParsed()
-        r = lib.rxkb_context_include_path_append(
-            self._context, path.encode('utf8'))
+        with self._lock:
+            if self._parsed:
+                raise RXKBAlreadyParsed()
+            r = lib.rxkb_context_include_path_append(
+                self._context, path.encode('utf8'))
         if r != 1:
             raise RXKBPathError("Failed to append to include path")
 
     def include_path_append_default(self):
         "Append the default include paths to the context's include path."
-        if self._parsed:
-            raise RXKBAlreadyParsed()
-        r = lib.rxkb_context_include_path_append_default(self._context)
+        with self._lock:
+            if self._parsed:
+                raise RXKBAlreadyParsed()
+            r = lib.rxkb_context_include_path_append_default(self._context)
         if r != 1:
             raise RXKBPathError("Failed to append default include paths")
 
@@ -168,63 +372,398 @@ class Context:
 
     def parse(self, ruleset):
         "Parse the given ruleset"
-        if self._parsed:
-            raise RXKBAlreadyParsed()
-        r = lib.rxkb_context_parse(self._context, ruleset.encode('utf8'))
-        if r != 1:
-            raise RXKBParseError()
-        self._parsed = True
+        with self._lock:
+            self._parse(lib.rxkb_context_parse, ruleset.encode('utf8'))
+            if self._preload:
+                self.warm()
 
     def parse_default_ruleset(self):
         "Parse the default ruleset as configured at build time"
+        with self._lock:
+            self._parse(lib.rxkb_context_parse_default_ruleset)
+            if self._preload:
+                self.warm()
+
+    def _parse(self, parse_fn, *args):
+        # Caller must hold self._lock
         if self._parsed:
             raise RXKBAlreadyParsed()
-        r = lib.rxkb_context_parse_default_ruleset(self._context)
+        r = parse_fn(self._context, *args)
         if r != 1:
             raise RXKBParseError()
         self._parsed = True
 
+    def _ensure_parsed(self):
+        # Caller must hold self._lock
+        if not self._parsed:
+            self._parse(lib.rxkb_context_parse_default_ruleset)
+
+    def warm(self, background=False):
+        """Build all registry data in a single pass.
+
+        Models, layouts, option groups, options and the options index
+        are all constructed now rather than on first access.  The
+        default ruleset is parsed first if no ruleset has been parsed
+        yet.
+
+        If background is set, the work is done in a daemon thread and
+        that thread is returned; otherwise None is returned.  Either
+        way, wait_warm() can be used to find out when the work is
+        complete.  Accessing the registry data while a background warm
+        is in progress blocks until it has finished.
+
+        Calling warm() again, for example to retry after a failure,
+        resets warmed and wait_warm() to report the new attempt.
+        """
+        with self._lock:
+            self._warm_started = True
+            self._warmed.clear()
+            self._warm_error = None
+        if background:
+            t = threading.Thread(target=self._warm_in_background,
+                                 daemon=True, name="rxkb-warm")
+            t.start()
+            return t
+        self._warm()
+
+    def _warm(self):
+        with self._lock:
+            try:
+                self._ensure_parsed()
+                if not hasattr(self, '_models'):
+                    self._load_models()
+                if not hasattr(self, '_layouts'):
+                    self._load_layouts()
+                if not hasattr(self, '_option_groups'):
+                    self._load_option_groups()
+            except Exception as e:
+                self._warm_error = e
+                raise
+            finally:
+                self._warmed.set()
+
+    def _warm_in_background(self):
+        try:
+            self._warm()
+        except Exception:
+            # Reported by warmed and wait_warm()
+            pass
+
+    def _check_warm_error(self):
+        if self._warm_error is not None:
+            raise RXKBWarmError() from self._warm_error
+
     @property
-    def models(self):
-        "Dictionary mapping model name to Model object"
-        if not hasattr(self, '_models'):
-            self._models = {}
-            if not self._parsed:
-                self.parse_default_ruleset()
-            model = lib.rxkb_model_first(self._context)
-            while model != ffi.NULL:
+    def warmed(self):
+        """True if warm() has completed
+
+        Raises RXKBWarmError if warm() failed.
+        """
+        if not self._warmed.is_set():
+            return False
+        self._check_warm_error()
+        return True
+
+    def wait_warm(self, timeout=None):
+        """Wait for warm() to complete.
+
+        Returns True if it has completed, or False if timeout (in
+        seconds) expired first.  Raises RXKBWarmError if warm()
+        failed, or if warm() has not been called yet: building the
+        registry data on first access does not count, and neither
+        does creating a context with preload set until a ruleset has
+        been parsed.
+        """
+        if not self._warm_started:
+            raise RXKBWarmError("warm() has not been called")
+        if not self._warmed.wait(timeout):
+            return False
+        self._check_warm_error()
+        return True
+
+    def _ensure_built(self, attr, loader):
+        """Build registry data on first access.
+
+        attr is the attribute that loader sets.
+        """
+        if not hasattr(self, attr):
+            with self._lock:
+                if not hasattr(self, attr):
+                    self._ensure_parsed()
+                    loader()
+
+    def _load_models(self):
+        models = {}
+        model = lib.rxkb_model_first(self._context)
+        while model != ffi.NULL:
+            if self._decoded_records is None:
                 x = Model(model)
-                self._models[x.name] = x
-                model = lib.rxkb_model_next(model)
+                models[x.name] = x
+            else:
+                models[ffi.string(
+                    lib.rxkb_model_get_name(model)).decode('ascii')] = model
+            model = lib.rxkb_model_next(model)
+        if self._decoded_records is not None:
+            models = _DecodedRecords(
+                self._context, models, Model, 'model',
+                self._decoded_records)
+        self._models = models
+
+    def _load_layouts(self):
+        layouts = {}
+        layout = lib.rxkb_layout_first(self._context)
+        while layout != ffi.NULL:
+            if self._decoded_records is None:
+                x = Layout(layout)
+                layouts[x.fullname] = x
+            else:
+                layouts[_layout_fullname(
+                    ffi.string(
+                        lib.rxkb_layout_get_name(layout)).decode('ascii'),
+                    _string_or_none(
+                        lib.rxkb_layout_get_variant(layout)))] = layout
+            layout = lib.rxkb_layout_next(layout)
+        if self._decoded_records is not None:
+            layouts = _DecodedRecords(
+                self._context, layouts, Layout, 'layout',
+                self._decoded_records)
+        self._layouts = layouts
+
+    def _load_option_groups(self):
+        option_groups = []
+        options = {}
+        option_index = {}
+        option_group = lib.rxkb_option_group_first(self._context)
+        while option_group != ffi.NULL:
+            x = OptionGroup(option_group)
+            for i, (name, option) in enumerate(x.options.items()):
+                options.setdefault(name, option)
+                option_index.setdefault(
+                    name, (len(option_groups), i, x, option))
+            option_groups.append(x)
+            option_group = lib.rxkb_option_group_next(option_group)
+        self._options = options
+        self._option_index = option_index
+        self._option_groups = option_groups
+
+    def _count_native(self):
+        # Caller must hold self._lock.  The parsed ruleset never
+        # changes, so the counts are only worked out once.
+        if hasattr(self, '_native_counts'):
+            return self._native_counts
+        counts = dict.fromkeys(_NATIVE_SIZE_ESTIMATES, 0)
+        if not self._parsed:
+            return counts
+        model = lib.rxkb_model_first(self._context)
+        while model != ffi.NULL:
+            counts['model'] += 1
+            model = lib.rxkb_model_next(model)
+        layout = lib.rxkb_layout_first(self._context)
+        while layout != ffi.NULL:
+            counts['layout'] += 1
+            for first_fn, next_fn in (
+                    (lib.rxkb_layout_get_iso639_first,
+                     lib.rxkb_iso639_code_next),
+                    (lib.rxkb_layout_get_iso3166_first,
+                     lib.rxkb_iso3166_code_next)):
+                code = first_fn(layout)
+                while code != ffi.NULL:
+                    counts['iso_code'] += 1
+                    code = next_fn(code)
+            layout = lib.rxkb_layout_next(layout)
+        option_group = lib.rxkb_option_group_first(self._context)
+        while option_group != ffi.NULL:
+            counts['option_group'] += 1
+            option = lib.rxkb_option_first(option_group)
+            while option != ffi.NULL:
+                counts['option'] += 1
+                option = lib.rxkb_option_next(option)
+            option_group = lib.rxkb_option_group_next(option_group)
+        self._native_counts = counts
+        return counts
+
+    def memory_usage(self):
+        """Estimate the memory used by this context, in bytes.
+
+        Returns a dictionary with the following keys:
+        - objects: Python objects, including the containers that hold
+          them, excluding their strings and frozensets
+        - strings: strings held by those objects
+        - frozensets: the sets of ISO codes held by Layout objects,
+          excluding the strings in them
+        - native: libxkbregistry's own allocations, estimated from
+          the number of items in the parsed ruleset
+        - total: the sum of all the above
+
+        Only registry data that has been built so far is counted.
+        """
+        tally = {'objects': 0, 'strings': 0, 'frozensets': 0}
+        seen = set()
+        with self._lock:
+            for attr in ('_models', '_layouts', '_option_groups',
+                         '_options', '_option_index', '_parsed_options'):
+                if hasattr(self, attr):
+                    _tally_memory(getattr(self, attr), tally, seen)
+            counts = self._count_native()
+        tally['native'] = sum(
+            n * _NATIVE_SIZE_ESTIMATES[kind] for kind, n in counts.items())
+        tally['total'] = sum(tally.values())
+        return tally
+
+    @property
+    def models(self):
+        """Dictionary mapping model name to Model object
+
+        If the context was created with max_decoded_records set, this
+        is a read-only mapping instead.
+        """
+        self._ensure_built('_models', self._load_models)
         return self._models
 
     @property
     def layouts(self):
-        "Dictionary mapping layout fullname to Layout object"
-        if not hasattr(self, '_layouts'):
-            self._layouts = {}
-            if not self._parsed:
-                self.parse_default_ruleset()
-            layout = lib.rxkb_layout_first(self._context)
-            while layout != ffi.NULL:
-                x = Layout(layout)
-                self._layouts[x.fullname] = x
-                layout = lib.rxkb_layout_next(layout)
+        """Dictionary mapping layout fullname to Layout object
+
+        If the context was created with max_decoded_records set, this
+        is a read-only mapping instead.
+        """
+        self._ensure_built('_layouts', self._load_layouts)
         return self._layouts
 
     @property
     def option_groups(self):
         "List of OptionGroup objects"
-        if not hasattr(self, '_option_groups'):
-            self._option_groups = []
-            if not self._parsed:
-                self.parse_default_ruleset()
-            option_group = lib.rxkb_option_group_first(self._context)
-            while option_group != ffi.NULL:
-                self._option_groups.append(OptionGroup(option_group))
-                option_group = lib.rxkb_option_group_next(option_group)
+        self._ensure_built('_option_groups', self._load_option_groups)
         return self._option_groups
 
+    @property
+    def options(self):
+        "Dictionary mapping option name to Option object, for all groups"
+        self._ensure_built('_option_groups', self._load_option_groups)
+        return self._options
+
+    def parse_options(self, s):
+        """Parse and canonicalise an XKB option string.
+
+        s is a comma-separated list of option names, as found in
+        XKB_DEFAULT_OPTIONS, for example
+        "grp:alt_shift_toggle,ctrl:nocaps,,compose:ralt".  Empty
+        entries and repeated options are dropped.
+
+        Returns a ParsedOptions object.  Results are cached, keyed by
+        the string passed in, so callers must not modify them.
+        """
+        self._ensure_built('_option_groups', self._load_option_groups)
+        return self._parsed_options.get(
+            s, lambda: _parse_options(s, self._option_index))
+
+
+class ParsedOptions:
+    """The result of parsing an XKB option string
+
+    options is a tuple of the recognised Option objects, in canonical
+    order: the order of their groups in the registry, then the order
+    of the options within each group.
+
+    unknown is a tuple of the option names that were not found in the
+    registry, in the order they were given.
+
+    conflicts is a tuple of (OptionGroup, options) pairs, one for each
+    group that does not allow multiple selection but had more than
+    one of its options given.
+
+    str() of this object is the canonical option string, which
+    includes only the recognised options.
+    """
+    def __init__(self, options, unknown, conflicts):
+        self.options = options
+        self.unknown = unknown
+        self.conflicts = conflicts
+
+    @property
+    def valid(self):
+        "True if all options were recognised and none conflict"
+        return not self.unknown and not self.conflicts
+
+    def __str__(self):
+        return ','.join(option.name for option in self.options)
+
+    def __repr__(self):
+        return f"rxkb.ParsedOptions('{self}')"
+
+
+class OverlayRegistry:
+    """Merged view of the registry data of several contexts
+
+    Contexts are given in order of precedence: where more than one
+    context has a model, layout, option group or option with the same
+    name, the one from the earliest context is used.
+
+    Option groups with the same name are merged: the merged group has
+    the name, description, allows_multiple setting and popularity of
+    the earliest group, and its options are those of the earliest
+    group followed by any further options from the groups it
+    shadows.  Where a group gains options this way, option_groups
+    holds a copy of it, so the contexts' own OptionGroup objects are
+    never altered.  Option groups without a name are never merged.
+
+    The merged data is built once, when the OverlayRegistry is
+    created; each context is warmed (see Context.warm()) and all of
+    its models and layouts are decoded, even if it was created with
+    max_decoded_records set.
+    """
+    def __init__(self, contexts):
+        self.contexts = tuple(contexts)
+        self.models = {}
+        self.layouts = {}
+        self.option_groups = []
+        self.options = {}
+        self._option_index = {}
+        group_positions = {}
+        merged = set()
+        for context in self.contexts:
+            context.warm()
+            for name, model in context.models.items():
+                self.models.setdefault(name, model)
+            for fullname, layout in context.layouts.items():
+                self.layouts.setdefault(fullname, layout)
+            for group in context.option_groups:
+                position = group_positions.get(group.name) \
+                    if group.name else None
+                if position is None:
+                    self.option_groups.append(group)
+                    if group.name:
+                        group_positions[group.name] = \
+                            len(self.option_groups) - 1
+                else:
+                    extra = {name: option
+                             for name, option in group.options.items()
+                             if name not in self.options}
+                    if extra:
+                        winner = self.option_groups[position]
+                        if id(winner) not in merged:
+                            winner = copy.copy(winner)
+                            winner.options = dict(winner.options)
+                            merged.add(id(winner))
+                            self.option_groups[position] = winner
+                        winner.options.update(extra)
+                for name, option in group.options.items():
+                    self.options.setdefault(name, option)
+        for position, group in enumerate(self.option_groups):
+            for i, (name, option) in enumerate(group.options.items()):
+                if self.options[name] is option:
+                    self._option_index[name] = (position, i, group, option)
+        self._parsed_options = _LRUCache(_PARSE_OPTIONS_CACHE_SIZE)
+
+    def parse_options(self, s):
+        """Parse and canonicalise an XKB option string.
+
+        As Context.parse_options(), but options are looked up in all
+        the contexts.
+        """
+        return self._parsed_options.get(
+            s, lambda: _parse_options(s, self._option_index))
+
 
 class Model:
     """An XKB model
@@ -283,7 +822,7 @@ class Layout:
 
     @property
     def fullname(self):
-        return f"{self.name}({self.variant})" if self.variant else self.name
+        return _layout_fullname(self.name, self.variant)
 
     def __str__(self):
         return self.fullname